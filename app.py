@@ -1,55 +1,269 @@
 import gradio as gr
 import requests
+import aiohttp
 import numpy as np
+import pandas as pd
+import io
+import csv
+import html
+import json
+import math
 import time
+import asyncio
+import shelve
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
 import folium
 from folium.plugins import PolyLineTextPath
 
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+USE_OSRM = True
+EARTH_RADIUS_KM = 6371
+ROAD_FACTOR = 1.3
+HAVERSINE_BLOCK = 128
+GEOCODE_WORKERS = 4
+OSRM_CONCURRENCY = 8
+OSRM_BACKOFF = [0.25, 0.5, 1.0]
+OSRM_MAX_FAILURES = 3
+OSRM_COOLDOWN_S = 300
+CACHE_PATH = ".vrptw_cache"
+
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "VRPTW-Gradio-App"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 # ============================================================
 # UTILITIES
 # ============================================================
 
+# Token bucket shared across threads; hands out `rate` tokens per second
+class RateLimiter:
+    def __init__(self, rate=1.0):
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def _reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        return wait
+    
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+    
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+# Nominatim usage policy: at most 1 request per second
+NOMINATIM_LIMITER = RateLimiter(rate=1.0)
+# Public OSRM demo server: spread per-pair requests to one every 0.125s
+OSRM_LIMITER = RateLimiter(rate=8.0)
+
+# On-disk cache shared across runs; shelve is not thread-safe so access is serialized
+_cache_lock = threading.Lock()
+
+def cache_get_many(keys):
+    with _cache_lock, shelve.open(CACHE_PATH) as db:
+        return [db.get(k) for k in keys]
+
+def cache_put_many(items):
+    with _cache_lock, shelve.open(CACHE_PATH) as db:
+        for k, v in items:
+            db[k] = v
+
+def pair_key(c1, c2):
+    return "osrm:" + ",".join(f"{round(x, 5):.5f}" for x in (*c1, *c2))
+
+@functools.lru_cache(maxsize=None)
 def get_coordinates(city):
+    key = f"geo:{city.strip().lower()}"
+    cached, = cache_get_many([key])
+    if cached is not None:
+        return cached
     url = "https://nominatim.openstreetmap.org/search"
     params = {"q": city, "format": "json", "limit": 1}
-    headers = {"User-Agent": "VRPTW-Gradio-App"}
-    res = requests.get(url, params=params, headers=headers, timeout=10)
+    NOMINATIM_LIMITER.acquire()
+    res = SESSION.get(url, params=params, timeout=10)
     data = res.json()
     if data:
-        return float(data[0]["lat"]), float(data[0]["lon"])
+        result = float(data[0]["lat"]), float(data[0]["lon"])
+        cache_put_many([(key, result)])
+        return result
     raise ValueError(f"Coordinates not found for {city}")
 
-def haversine_distance(c1, c2):
-    lat1, lon1 = c1
-    lat2, lon2 = c2
-    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
-    c = 2 * np.arcsin(np.sqrt(a))
-    r = 6371
-    distance_km = r * c
-    time_minutes = (distance_km * 1.3 / 50) * 60
-    return distance_km * 1.3, time_minutes
-
-def get_osrm_distance_time(c1, c2, max_retries=3):
+if HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _haversine_kernel(lat, lon, out):
+        n = lat.shape[0]
+        for i in prange(n):
+            out[i, i] = 0.0
+            for j in range(i + 1, n):
+                a = (math.sin((lat[j] - lat[i]) / 2) ** 2
+                     + math.cos(lat[i]) * math.cos(lat[j]) * math.sin((lon[j] - lon[i]) / 2) ** 2)
+                d = 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a))) * ROAD_FACTOR
+                out[i, j] = d
+                out[j, i] = d
+
+def _haversine_block(lat_i, lon_i, lat_j, lon_j):
+    lat_i, lon_i = lat_i[:, None], lon_i[:, None]
+    dlat = lat_j - lat_i
+    dlon = lon_j - lon_i
+    a = np.sin(dlat/2)**2 + np.cos(lat_i) * np.cos(lat_j) * np.sin(dlon/2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a)) * ROAD_FACTOR
+
+def haversine_matrix(coords_array):
+    C = np.radians(np.asarray(coords_array, dtype=float))
+    lat, lon = np.ascontiguousarray(C[:, 0]), np.ascontiguousarray(C[:, 1])
+    n = len(C)
+    out = np.empty((n, n), dtype=np.float32)
+    if HAS_NUMBA:
+        _haversine_kernel(lat, lon, out)
+        return out
+    # Tile so each block's temporaries stay cache-resident; compute upper blocks and mirror
+    B = HAVERSINE_BLOCK
+    for i0 in range(0, n, B):
+        for j0 in range(i0, n, B):
+            block = _haversine_block(lat[i0:i0+B], lon[i0:i0+B], lat[j0:j0+B], lon[j0:j0+B])
+            out[i0:i0+B, j0:j0+B] = block
+            if j0 != i0:
+                out[j0:j0+B, i0:i0+B] = block.T
+    return out
+
+# Circuit breaker: after OSRM_MAX_FAILURES consecutive failed requests, OSRM is skipped
+# (haversine only) until the cooldown expires. Shared by all Gradio worker threads.
+_osrm_lock = threading.Lock()
+_osrm_failures = 0
+_osrm_open_until = 0.0
+
+def osrm_available():
+    with _osrm_lock:
+        return time.monotonic() >= _osrm_open_until
+
+def record_osrm_result(ok):
+    global _osrm_failures, _osrm_open_until
+    with _osrm_lock:
+        if ok:
+            _osrm_failures = 0
+            return
+        _osrm_failures += 1
+        if _osrm_failures >= OSRM_MAX_FAILURES:
+            _osrm_open_until = time.monotonic() + OSRM_COOLDOWN_S
+
+async def get_osrm_distance_time(session, c1, c2):
     lat1, lon1 = c1
     lat2, lon2 = c2
-    for attempt in range(max_retries):
+    url = f"https://router.project-osrm.org/route/v1/driving/{lon1},{lat1};{lon2},{lat2}?overview=false"
+    for delay in (*OSRM_BACKOFF, None):
+        if not osrm_available():
+            return None
         try:
-            url = f"https://router.project-osrm.org/route/v1/driving/{lon1},{lat1};{lon2},{lat2}?overview=false"
-            res = requests.get(url, timeout=15)
-            data = res.json()
+            await OSRM_LIMITER.acquire_async()
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=15)) as res:
+                data = await res.json(content_type=None)
+            record_osrm_result(True)
             if data["code"] == "Ok":
                 return (data["routes"][0]["distance"] / 1000, data["routes"][0]["duration"] / 60)
-        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-            if attempt < max_retries - 1:
-                time.sleep(2)
-            continue
-        except:
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, IndexError, TypeError):
+            record_osrm_result(False)
+            # Don't back off just to find the breaker open
+            if delay is None or not osrm_available():
+                return None
+            await asyncio.sleep(delay)
+
+async def fetch_osrm_pairs(coord_pairs):
+    sem = asyncio.Semaphore(OSRM_CONCURRENCY)
+    async with aiohttp.ClientSession(headers={"User-Agent": "VRPTW-Gradio-App"}) as session:
+        async def one(c1, c2):
+            async with sem:
+                return await get_osrm_distance_time(session, c1, c2)
+        return await asyncio.gather(*(one(c1, c2) for c1, c2 in coord_pairs))
+
+def get_osrm_table(ordered_coords):
+    coord_str = ";".join(f"{lon},{lat}" for lat, lon in ordered_coords)
+    url = f"https://router.project-osrm.org/table/v1/driving/{coord_str}?annotations=distance,duration"
+    for delay in (*OSRM_BACKOFF, None):
+        if not osrm_available():
+            return None
+        try:
+            res = SESSION.get(url, timeout=30)
+            data = res.json()
+            record_osrm_result(True)
+            if data.get("code") != "Ok":
+                return None
+            D = (np.asarray(data["distances"], dtype=float) / 1000.0).astype(np.float32)
+            T = (np.asarray(data["durations"], dtype=float) / 60.0).astype(np.float32)
             break
-    return haversine_distance(c1, c2)
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            record_osrm_result(False)
+            # Don't back off just to find the breaker open
+            if delay is None or not osrm_available():
+                return None
+            time.sleep(delay)
+    # Unroutable pairs come back as null; patch distances with the haversine estimate.
+    # Durations are only kept for the cache, so unrouted entries stay NaN.
+    missing = np.isnan(D) | np.isnan(T)
+    if missing.any():
+        D[missing] = haversine_matrix(ordered_coords)[missing]
+    return D, T, missing
+
+# Fallback when /table is refused: one /route request per pair, issued concurrently.
+# Only the upper triangle is queried; the result is mirrored for this run but only the requested
+# direction counts as routed, since road distances are not symmetric. Failed pairs keep the
+# haversine estimate.
+def get_osrm_pairwise(ordered_coords):
+    n = len(ordered_coords)
+    D = haversine_matrix(ordered_coords)
+    T = np.full((n, n), np.nan, dtype=np.float32)
+    np.fill_diagonal(T, 0.0)
+    routed = np.zeros((n, n), dtype=bool)
+    pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+    results = asyncio.run(fetch_osrm_pairs([(ordered_coords[i], ordered_coords[j]) for i, j in pairs]))
+    for (i, j), result in zip(pairs, results):
+        if result is not None:
+            D[i, j] = D[j, i] = result[0]
+            T[i, j] = T[j, i] = result[1]
+            routed[i, j] = True
+    return D, T, routed
+
+def get_cached_osrm_table(ordered_coords):
+    n = len(ordered_coords)
+    pairs = [(i, j) for i in range(n) for j in range(n) if i != j]
+    keys = [pair_key(ordered_coords[i], ordered_coords[j]) for i, j in pairs]
+    cached = cache_get_many(keys)
+    if all(c is not None for c in cached):
+        D, T = np.zeros((n, n), dtype=np.float32), np.zeros((n, n), dtype=np.float32)
+        for (i, j), (km, minutes) in zip(pairs, cached):
+            D[i, j], T[i, j] = km, minutes
+        return D, T
+    
+    table = get_osrm_table(ordered_coords)
+    if table is not None:
+        D, T, missing = table
+        routed = ~missing
+    elif not osrm_available():
+        return None
+    else:
+        D, T, routed = get_osrm_pairwise(ordered_coords)
+        if not routed.any():
+            return None
+    cache_put_many((k, (float(D[i, j]), float(T[i, j])))
+                   for (i, j), k in zip(pairs, keys) if routed[i, j])
+    return D, T
 
 def sanitize_coord(coord):
     a, b = coord
@@ -59,76 +273,111 @@ def sanitize_coord(coord):
 # ROUTING ALGORITHM
 # ============================================================
 
+ROUTES_HEADER = "=" * 60 + "\n🚚 VEHICLE ROUTES\n" + "=" * 60 + "\n\n"
+ROUTES_SEPARATOR = "-" * 60 + "\n\n"
+
+# One record per leg; city fields are indices into `cities`, times are minutes from vehicle start
+LEG_DTYPE = np.dtype([
+    ('from_idx', np.int32), ('to_idx', np.int32),
+    ('depart_min', np.float64), ('arrive_min', np.float64),
+    ('deliver', np.float64), ('unload', np.float64), ('distance', np.float32),
+])
+
+def _grow(a):
+    grown = np.empty(2 * a.shape[0], a.dtype)
+    grown[:a.shape[0]] = a
+    return grown
+
+def _push_leg(legs, n, a, b, depart_min, arrive_min, deliver):
+    from_idx, to_idx, depart, arrive, delivered = legs
+    if n == from_idx.shape[0]:
+        from_idx, to_idx = _grow(from_idx), _grow(to_idx)
+        depart, arrive, delivered = _grow(depart), _grow(arrive), _grow(delivered)
+    from_idx[n] = a
+    to_idx[n] = b
+    depart[n] = depart_min
+    arrive[n] = arrive_min
+    delivered[n] = deliver
+    return from_idx, to_idx, depart, arrive, delivered
+
+# Greedy refill-aware simulation of one vehicle over index arrays.
+# Mutates `remaining` in place; returns per-leg arrays (from_idx, to_idx, depart_min, arrive_min, deliver).
+def _simulate_core(T, remaining, demand_idx, capacity, depot_idx, unload_per_100kg):
+    size = 2 * demand_idx.shape[0] + 1
+    legs = (np.empty(size, np.int64), np.empty(size, np.int64),
+            np.empty(size), np.empty(size), np.empty(size))
+    n = 0
+    time_min = 0.0
+    location = depot_idx
+    load = capacity
+    # Refilling beats sending a fresh vehicle iff T[loc, depot] + T[depot, c] <= T[depot, c],
+    # i.e. iff the trip back to the depot is free, which does not depend on the target city
+    can_refill = T[:, depot_idx] <= 0
+    for k in range(demand_idx.shape[0]):
+        city = demand_idx[k]
+        while remaining[k] > 0:
+            # Delivery and refill legs share one update; the refill flag selects the values
+            refill = load <= 0
+            if refill and not can_refill[location]:
+                break
+            dest = depot_idx if refill else city
+            deliver = 0.0 if refill else min(load, remaining[k])
+            arrive_min = time_min + T[location, dest]
+            legs = _push_leg(legs, n, location, dest, time_min, arrive_min, deliver)
+            n += 1
+            time_min = arrive_min + (deliver / 100) * unload_per_100kg
+            remaining[k] -= deliver
+            load = capacity if refill else load - deliver
+            location = dest
+    
+    if location != depot_idx:
+        arrive_depot = time_min + T[location, depot_idx]
+        legs = _push_leg(legs, n, location, depot_idx, time_min, arrive_depot, 0.0)
+        n += 1
+    from_idx, to_idx, depart, arrive, delivered = legs
+    return from_idx[:n], to_idx[:n], depart[:n], arrive[:n], delivered[:n]
+
+if HAS_NUMBA:
+    _grow = njit(cache=True)(_grow)
+    _push_leg = njit(cache=True)(_push_leg)
+    _simulate_core = njit(cache=True)(_simulate_core)
+
 def run_vrptw(vehicles, demands, cities, coords, distance_matrix, depot):
     SPEED_KMPH = 60
     UNLOAD_MIN_PER_100KG = 30
     demands_copy = {d['city']: {'remaining': d['demand']} for d in demands}
+    city_idx = {c: i for i, c in enumerate(cities)}
+    depot_idx = city_idx[depot]
+    D = np.asarray(distance_matrix, dtype=np.float32)
+    T = (D / SPEED_KMPH) * 60.0
     
-    def travel_time_minutes(a, b):
-        i, j = cities.index(a), cities.index(b)
-        return (distance_matrix[i][j] / SPEED_KMPH) * 60
+    demand_cities = list(demands_copy.keys())
+    demand_idx = np.array([city_idx[c] for c in demand_cities], dtype=np.int64)
+    remaining = np.array([demands_copy[c]['remaining'] for c in demand_cities], dtype=np.float64)
     
-    def dist_between(a, b):
-        i, j = cities.index(a), cities.index(b)
-        return distance_matrix[i][j]
+    def simulate_vehicle(vehicle, remaining):
+        return _simulate_core(T, remaining, demand_idx, float(vehicle['capacity']),
+                              depot_idx, float(UNLOAD_MIN_PER_100KG))
     
-    def simulate_vehicle(vehicle, demands):
+    def build_route(vehicle, arrays):
         start_dt = datetime.strptime(f"{vehicle['startDate']} {vehicle['startTime']}", "%Y-%m-%d %H:%M")
-        time_var = start_dt
-        location = depot
-        capacity = vehicle['capacity']
-        route = []
-        demand_cities = list(demands.keys())
-        
-        for city in demand_cities:
-            while demands[city]['remaining'] > 0:
-                if capacity > 0:
-                    travel_min = travel_time_minutes(location, city)
-                    arrive = time_var + timedelta(minutes=travel_min)
-                    deliver = min(capacity, demands[city]['remaining'])
-                    unload = (deliver / 100) * UNLOAD_MIN_PER_100KG
-                    route.append({
-                        'from': location, 'to': city, 'depart': time_var,
-                        'arrive': arrive, 'deliver': deliver, 'unload': unload,
-                        'distance': dist_between(location, city)
-                    })
-                    time_var = arrive + timedelta(minutes=unload)
-                    demands[city]['remaining'] -= deliver
-                    capacity -= deliver
-                    location = city
-                else:
-                    refill_time = travel_time_minutes(location, depot) + travel_time_minutes(depot, city)
-                    new_vehicle_time = travel_time_minutes(depot, city)
-                    if refill_time <= new_vehicle_time:
-                        back = travel_time_minutes(location, depot)
-                        arrive_depot = time_var + timedelta(minutes=back)
-                        route.append({
-                            'from': location, 'to': depot, 'depart': time_var,
-                            'arrive': arrive_depot, 'deliver': 0, 'unload': 0,
-                            'distance': dist_between(location, depot)
-                        })
-                        time_var = arrive_depot
-                        location = depot
-                        capacity = vehicle['capacity']
-                    else:
-                        break
-        
-        if location != depot:
-            back = travel_time_minutes(location, depot)
-            arrive_depot = time_var + timedelta(minutes=back)
-            route.append({
-                'from': location, 'to': depot, 'depart': time_var,
-                'arrive': arrive_depot, 'deliver': 0, 'unload': 0,
-                'distance': dist_between(location, depot)
-            })
-        return route
+        from_idx, to_idx, depart, arrive, deliver = arrays
+        legs = np.empty(len(from_idx), dtype=LEG_DTYPE).view(np.recarray)
+        legs.from_idx = from_idx
+        legs.to_idx = to_idx
+        legs.depart_min = depart
+        legs.arrive_min = arrive
+        legs.deliver = deliver
+        legs.unload = (deliver / 100) * UNLOAD_MIN_PER_100KG
+        legs.distance = D[from_idx, to_idx]
+        return {'start': start_dt, 'legs': legs}
     
     solution = {}
     for v in vehicles:
-        if any(d['remaining'] > 0 for d in demands_copy.values()):
-            route = simulate_vehicle(v, demands_copy)
-            if route:
-                solution[v['id']] = route
+        if (remaining > 0).any():
+            arrays = simulate_vehicle(v, remaining)
+            if len(arrays[0]):
+                solution[v['id']] = build_route(v, arrays)
     return solution
 
 # ============================================================
@@ -139,71 +388,59 @@ def process_vehicles(vehicle_data):
     vehicles = []
     if not vehicle_data or not vehicle_data.strip():
         return vehicles
-    lines = vehicle_data.strip().split('\n')
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if line:
-            parts = [p.strip() for p in line.split(',')]
-            if len(parts) >= 3:
-                try:
-                    vehicles.append({
-                        'id': i + 1,
-                        'capacity': float(parts[0]),
-                        'startDate': parts[1],
-                        'startTime': parts[2]
-                    })
-                except:
-                    pass
-    return vehicles
+    # Blank lines are kept as empty rows so vehicle ids match input line numbers
+    try:
+        df = pd.read_csv(io.StringIO(vehicle_data.strip()), header=None, usecols=[0, 1, 2],
+            names=["capacity", "startDate", "startTime"], dtype=str, quoting=csv.QUOTE_NONE,
+            skipinitialspace=True, skip_blank_lines=False)
+    except pd.errors.ParserError:
+        # Raised when no line has three fields
+        return vehicles
+    df = df.apply(lambda col: col.str.strip())
+    df["capacity"] = pd.to_numeric(df["capacity"], errors="coerce")
+    df = df.dropna()
+    df.insert(0, "id", df.index + 1)
+    return df.to_dict(orient="records")
 
 def process_demands(demand_data):
     demands = []
     if not demand_data or not demand_data.strip():
         return demands
-    lines = demand_data.strip().split('\n')
-    for line in lines:
-        line = line.strip()
-        if line:
-            parts = [p.strip() for p in line.split(',')]
-            if len(parts) >= 4:
-                try:
-                    city = ', '.join(parts[:-3])
-                    demand_val = float(parts[-3])
-                    tw_start = parts[-2]
-                    tw_end = parts[-1]
-                    demands.append({
-                        'city': city, 'demand': demand_val,
-                        'tw_start': tw_start, 'tw_end': tw_end
-                    })
-                except:
-                    pass
-    return demands
+    # City names may contain commas, so only the last three fields are split off
+    lines = pd.Series(demand_data.strip().split('\n'))
+    df = lines.str.rsplit(',', n=3, expand=True)
+    if df.shape[1] < 4:
+        return demands
+    df = df.apply(lambda col: col.str.strip())
+    df.columns = ["city", "demand", "tw_start", "tw_end"]
+    df["city"] = df["city"].str.replace(r"\s*,\s*", ", ", regex=True)
+    df["demand"] = pd.to_numeric(df["demand"], errors="coerce")
+    return df.dropna().to_dict(orient="records")
 
 def build_matrices(supply_location, vehicles, demands, progress=gr.Progress()):
     progress(0, desc="Starting...")
-    cities = [supply_location] + [d['city'] for d in demands]
+    # Deduplicate while keeping order; everything downstream indexes by city name
+    cities = list(dict.fromkeys([supply_location] + [d['city'] for d in demands]))
     coords = {}
     
     progress(0.2, desc="Fetching coordinates...")
-    for i, city in enumerate(cities):
-        lat, lon = get_coordinates(city)
-        coords[city] = (lat, lon)
-        time.sleep(1)
-        progress(0.2 + (0.3 * (i + 1) / len(cities)), desc=f"Got coordinates for {city}")
+    pool = ThreadPoolExecutor(max_workers=GEOCODE_WORKERS)
+    try:
+        futures = {pool.submit(get_coordinates, city): city for city in cities}
+        for i, future in enumerate(as_completed(futures)):
+            city = futures[future]
+            coords[city] = future.result()
+            progress(0.2 + (0.3 * (i + 1) / len(cities)), desc=f"Got coordinates for {city}")
+    except Exception:
+        # Fail fast: drop queued lookups instead of waiting out the rate limiter for each
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
     
-    n = len(cities)
-    D = np.zeros((n, n))
     progress(0.5, desc="Computing distances...")
-    total_pairs = n * (n - 1)
-    pair_count = 0
-    
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                D[i, j], _ = get_osrm_distance_time(coords[cities[i]], coords[cities[j]])
-                time.sleep(0.5)
-                pair_count += 1
-                progress(0.5 + (0.4 * pair_count / total_pairs), desc=f"Computing routes...")
+    ordered_coords = [coords[c] for c in cities]
+    table = get_cached_osrm_table(ordered_coords) if USE_OSRM else None
+    D = table[0] if table is not None else haversine_matrix(ordered_coords)
     
     progress(0.9, desc="Building solution...")
     return cities, coords, D
@@ -227,9 +464,9 @@ def generate_routes(supply_location, vehicle_data, demand_data, progress=gr.Prog
         if not solution:
             return "❌ Error: No solution found", "", "<p>No map available</p>"
         
-        routes_text = generate_routes_text(solution, supply_location.strip())
+        routes_text = generate_routes_text(solution, cities, supply_location.strip())
         summary_text = generate_summary(solution, cities, supply_location.strip(), distance_matrix)
-        map_html = generate_map(solution, coords, supply_location.strip())
+        map_html = generate_map(solution, cities, coords, supply_location.strip())
         
         progress(1.0, desc="Complete!")
         return routes_text, summary_text, map_html
@@ -240,51 +477,57 @@ def generate_routes(supply_location, vehicle_data, demand_data, progress=gr.Prog
         print(error_details)
         return f"❌ Error: {str(e)}\n\nDetails:\n{error_details}", "", "<p>Error</p>"
 
-def generate_routes_text(solution, depot):
-    output = ["=" * 60, "🚚 VEHICLE ROUTES", "=" * 60, ""]
+def generate_routes_text(solution, cities, depot):
+    # Refill legs depart exactly when the previous leg arrives, so timestamps repeat
+    fmt_cache = {}
+    def fmt(start, minutes):
+        key = (start, minutes)
+        text = fmt_cache.get(key)
+        if text is None:
+            text = f"{start + timedelta(minutes=float(minutes)):%d %b %Y, %I:%M %p}"
+            fmt_cache[key] = text
+        return text
+    
+    buf = io.StringIO()
+    buf.write(ROUTES_HEADER)
     for vid, route in solution.items():
-        output.append(f"🚚 Vehicle {vid}")
-        output.append("")
-        for i, leg in enumerate(route, 1):
-            tag = "REFILL/RETURN" if leg['to'] == depot else "DELIVERY"
-            output.append(f"  ➤ Route {i}: {leg['from']} → {leg['to']} [{tag}]")
-            output.append(f"     Depart  : {leg['depart'].strftime('%d %b %Y, %I:%M %p')}")
-            output.append(f"     Arrive  : {leg['arrive'].strftime('%d %b %Y, %I:%M %p')}")
-            output.append(f"     Distance: {leg['distance']:.2f} km")
-            if leg['deliver'] > 0:
-                output.append(f"     Unload  : {leg['deliver']:.0f} kg ({leg['unload']:.0f} min)")
-            output.append("")
-        output.append("-" * 60)
-        output.append("")
-    return "\n".join(output)
+        buf.write(f"🚚 Vehicle {vid}\n\n")
+        start = route['start']
+        for i, leg in enumerate(route['legs'], 1):
+            src, dst = cities[leg.from_idx], cities[leg.to_idx]
+            tag = "REFILL/RETURN" if dst == depot else "DELIVERY"
+            buf.write(f"  ➤ Route {i}: {src} → {dst} [{tag}]\n"
+                      f"     Depart  : {fmt(start, leg.depart_min)}\n"
+                      f"     Arrive  : {fmt(start, leg.arrive_min)}\n"
+                      f"     Distance: {leg.distance:.2f} km\n")
+            if leg.deliver > 0:
+                buf.write(f"     Unload  : {leg.deliver:.0f} kg ({leg.unload:.0f} min)\n")
+            buf.write("\n")
+        buf.write(ROUTES_SEPARATOR)
+    # Drop the final newline so the text ends on the trailing blank line, as before
+    return buf.getvalue()[:-1]
 
 def generate_summary(solution, cities, depot, distance_matrix):
-    total_distance = 0
-    max_time = 0
-    bottleneck_vehicle = None
     vehicle_stats = []
     
     for vid, route in solution.items():
-        visited = []
-        dist = 0
-        start = route[0]['depart']
-        end = route[-1]['arrive']
-        for leg in route:
-            if leg['from'] not in visited:
-                visited.append(leg['from'])
-            if leg['to'] not in visited:
-                visited.append(leg['to'])
-            dist += leg['distance']
-        time_hours = (end - start).total_seconds() / 3600
+        legs = route['legs']
+        # Each leg starts where the previous one ended, so first 'from' + every 'to' covers all stops
+        stops = np.concatenate([legs.from_idx[:1], legs.to_idx])
+        visited = [cities[i] for i in dict.fromkeys(stops.tolist())]
+        dist = float(legs.distance.sum(dtype=np.float64))
+        time_hours = (legs.arrive_min[-1] - legs.depart_min[0]) / 60
         avg_speed = dist / time_hours if time_hours > 0 else 0
         vehicle_stats.append({
             'id': vid, 'route': visited, 'distance': dist,
             'time': time_hours, 'avg_speed': avg_speed
         })
-        total_distance += dist
-        if time_hours > max_time:
-            max_time = time_hours
-            bottleneck_vehicle = vid
+    
+    distances = np.array([v['distance'] for v in vehicle_stats])
+    times = np.array([v['time'] for v in vehicle_stats])
+    total_distance = distances.sum()
+    max_time = max(times.max(), 0)
+    bottleneck_vehicle = vehicle_stats[int(np.argmax(times))]['id'] if max_time > 0 else None
     
     summary = []
     summary.append("📊 OVERALL DELIVERY SUMMARY")
@@ -309,42 +552,68 @@ def generate_summary(solution, cities, depot, distance_matrix):
     summary.append("- Greedy refill-aware strategy ensures realism")
     return "\n".join(summary)
 
-def generate_map(solution, coords, depot):
+# Tiles and city markers only depend on the coordinates, so the rendered base map is reused
+# across runs and the routes are spliced in as a plain Leaflet script.
+@functools.lru_cache(maxsize=32)
+def _build_base_map(coords_key, depot):
+    coords_clean = dict(coords_key)
+    lats = [lat for lat, lon in coords_clean.values()]
+    lons = [lon for lat, lon in coords_clean.values()]
+    min_lat, max_lat = min(lats), max(lats)
+    min_lon, max_lon = min(lons), max(lons)
+    
+    m = folium.Map(tiles="CartoDB positron", control_scale=True, zoom_control=True)
+    m.fit_bounds([[min_lat - 1, min_lon - 1], [max_lat + 1, max_lon + 1]], padding=(30, 30))
+    
+    depot_lat, depot_lon = coords_clean[depot]
+    folium.Marker([depot_lat, depot_lon], icon=folium.Icon(color="red", icon="star", prefix="fa"),
+        tooltip=f"SUPPLY: {depot}").add_to(m)
+    
+    for city, (lat, lon) in coords_clean.items():
+        if city != depot:
+            folium.CircleMarker([lat, lon], radius=5, color="black", fill=True,
+                fill_color="white", tooltip=city).add_to(m)
+    
+    return m._repr_html_(), m.get_name()
+
+def _overlay_routes(base_html, map_name, solution, cities, coords_clean):
+    vehicle_colors = ["blue", "green", "purple", "orange", "darkred"]
+    def offset_point(p, off):
+        return (p[0] + off, p[1] + off)
+    
+    lines = []
+    for v_idx, (vid, route) in enumerate(solution.items()):
+        color = vehicle_colors[v_idx % len(vehicle_colors)]
+        offset = 0.03 * v_idx
+        for step_idx, leg in enumerate(route['legs'], start=1):
+            lat1, lon1 = offset_point(coords_clean[cities[leg.from_idx]], offset)
+            lat2, lon2 = offset_point(coords_clean[cities[leg.to_idx]], offset)
+            lines.append([[lat1, lon1], [lat2, lon2], color, f"Vehicle {vid} | Route {step_idx}", str(step_idx)])
+    
+    # Escape "</" so user-supplied text can never close the script block early
+    data = json.dumps(lines).replace("</", "<\\/")
+    textpath_js = "".join(f'<script src="{url}"></script>' for _, url in PolyLineTextPath.default_js)
+    # Folium defines the map in a script after </body>, so wait for the document to finish parsing
+    script = textpath_js + f"""<script>
+    document.addEventListener("DOMContentLoaded", function() {{
+        {data}.forEach(function(l) {{
+            var line = L.polyline([l[0], l[1]], {{color: l[2], weight: 3, opacity: 0.9}}).addTo({map_name});
+            line.bindTooltip(l[3], {{sticky: true}});
+            line.setText(l[4], {{repeat: false, offset: 7,
+                attributes: {{"fill": l[2], "font-weight": "bold", "font-size": "12"}}}});
+        }});
+    }});
+</script>
+"""
+    # The map document sits HTML-escaped inside the iframe srcdoc; insert before its </body>
+    end = base_html.rfind(html.escape("</body>"))
+    return base_html[:end] + html.escape(script) + base_html[end:]
+
+def generate_map(solution, cities, coords, depot):
     try:
         coords_clean = {city: sanitize_coord(c) for city, c in coords.items()}
-        lats = [lat for lat, lon in coords_clean.values()]
-        lons = [lon for lat, lon in coords_clean.values()]
-        min_lat, max_lat = min(lats), max(lats)
-        min_lon, max_lon = min(lons), max(lons)
-        
-        m = folium.Map(tiles="CartoDB positron", control_scale=True, zoom_control=True)
-        m.fit_bounds([[min_lat - 1, min_lon - 1], [max_lat + 1, max_lon + 1]], padding=(30, 30))
-        
-        depot_lat, depot_lon = coords_clean[depot]
-        folium.Marker([depot_lat, depot_lon], icon=folium.Icon(color="red", icon="star", prefix="fa"),
-            tooltip=f"SUPPLY: {depot}").add_to(m)
-        
-        for city, (lat, lon) in coords_clean.items():
-            if city != depot:
-                folium.CircleMarker([lat, lon], radius=5, color="black", fill=True,
-                    fill_color="white", tooltip=city).add_to(m)
-        
-        vehicle_colors = ["blue", "green", "purple", "orange", "darkred"]
-        def offset_point(p, off):
-            return (p[0] + off, p[1] + off)
-        
-        for v_idx, (vid, route) in enumerate(solution.items()):
-            color = vehicle_colors[v_idx % len(vehicle_colors)]
-            offset = 0.03 * v_idx
-            for step_idx, leg in enumerate(route, start=1):
-                lat1, lon1 = offset_point(coords_clean[leg['from']], offset)
-                lat2, lon2 = offset_point(coords_clean[leg['to']], offset)
-                polyline = folium.PolyLine([[lat1, lon1], [lat2, lon2]], color=color, weight=3,
-                    opacity=0.9, tooltip=f"Vehicle {vid} | Route {step_idx}").add_to(m)
-                PolyLineTextPath(polyline, text=str(step_idx), repeat=False, offset=7,
-                    attributes={"fill": color, "font-weight": "bold", "font-size": "12"}).add_to(m)
-        
-        return m._repr_html_()
+        base_html, map_name = _build_base_map(frozenset(coords_clean.items()), depot)
+        return _overlay_routes(base_html, map_name, solution, cities, coords_clean)
     except Exception as e:
         return f"<p>Error: {str(e)}</p>"
 